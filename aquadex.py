@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
 
 import json
-import math
 import struct
 import base64
 import asyncio
-import krock32
+import functools
+import websockets
+import hashlib
+import itertools
+from array import array
 from decimal import Decimal
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from aquadex_client import program_id as client_program_id
 from solana.rpc import types
-from solana.transaction import Transaction
+from solana.transaction import Transaction, PACKET_DATA_SIZE
+from solders.hash import Hash
+from solders.compute_budget import set_compute_unit_limit
 from solders.pubkey import Pubkey
+from solders.transaction_status import TransactionConfirmationStatus
 from anchorpy import Program, Context, Idl, EventParser
-from anchorpy.program.common import translate_address
+from anchorpy.program.common import translate_address, Event
+from anchorpy_core.idl import IdlTypeSimple
 from aquadex_client.accounts import Market, MarketState, UserVault, TradeResult
 from aquadex_client.instructions import limit_bid, limit_ask, market_bid, market_ask, cancel_order, withdraw as log_withdraw, vault_withdraw
 
@@ -21,9 +32,51 @@ __all__ = ['AquadexClient']
 DEFAULT_AQUADEX_PROGRAM_ID = Pubkey.from_string('AQUA3y76EwUE2CgxbaMUMpa54G8PyGRExRdhLK8bN4VR')
 DEFAULT_OPTIONS = types.TxOpts(skip_confirmation=True, preflight_commitment='processed')
 
+# Compute units a transaction may use and the default allotment per instruction
+MAX_TX_UNITS = 1400000
+DEFAULT_IX_UNITS = 200000
+
 SPL_TOKEN = Pubkey.from_string('TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA')
 ASC_TOKEN = Pubkey.from_string('ATokenGPvbdGVxr1b2hvZbsiqW5xWH25efTNsLJA8knL')
 
+PAGE_SIZE = 16384
+TYPE_PAGE = struct.Struct('<3Q16H')
+MAP_HEADER = struct.Struct('<2Q2IQ')
+VEC_HEADER = struct.Struct('<2I')
+NODE_TAG = struct.Struct('<I')
+INNER_NODE = struct.Struct('<I16s3I24s')
+INNER_CHILDREN = struct.Struct('<2I')
+LEAF_NODE = struct.Struct('<2I16s32s')
+FREE_NODE = struct.Struct('<2I48s')
+ORDER_ITEM = struct.Struct('<Qq')
+SETTLE_ITEM = struct.Struct('<QQq')
+SETTLE_HEADER = struct.Struct('<32s32s32sIH')
+
+CROCKFORD_ENCODE = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', b'0123456789abcdefghjkmnpqrstvwxyz')
+CROCKFORD_DECODE = str.maketrans('0123456789abcdefghjkmnpqrstvwxyzilo', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567BBA')
+
+# Struct formats for the fixed size IDL types used in program events
+EVENT_FIELDS = {
+    IdlTypeSimple.Bool: '?',
+    IdlTypeSimple.U8: 'B',
+    IdlTypeSimple.U64: 'Q',
+    IdlTypeSimple.I64: 'q',
+    IdlTypeSimple.U128: '16s',
+    IdlTypeSimple.PublicKey: '32s',
+}
+PROGRAM_DATA = ('Program data: ', 'Program log: ')
+
+CONFIRMED_STATUS = [TransactionConfirmationStatus.Confirmed, TransactionConfirmationStatus.Finalized]
+
+# Slab layouts keyed by (header_size, offset_size)
+SLAB_LAYOUTS = {}
+
+if np is not None:
+    # Leaf view of a 56-byte slab node, the order key is split into two u64 words (key_hi is the price)
+    LEAF_DTYPE = np.dtype([('tag', '<u4'), ('slot', '<u4'), ('key_lo', '<u8'), ('key_hi', '<u8'), ('owner', 'V32')])
+    ORDER_DTYPE = np.dtype([('amount', '<u8'), ('expiry', '<i8')])
+    SETTLE_DTYPE = np.dtype([('mkt_token_balance', '<u8'), ('prc_token_balance', '<u8'), ('ts_updated', '<i8')])
+
 def associated_token(token_mint, wallet, bump_seed=False):
     ata = Pubkey.find_program_address([bytes(wallet), bytes(SPL_TOKEN), bytes(token_mint)], ASC_TOKEN)
     if bump_seed:
@@ -36,29 +89,113 @@ def program_address(seeds, program_id, bump_seed=False):
         return pda
     return str(pda[0])
 
+def transaction_size(instructions, fee_payer):
+    # Wire size with room for the compute unit limit instruction build_transaction may prepend
+    tx = Transaction(recent_blockhash=Hash.default(), fee_payer=fee_payer)
+    tx.add(set_compute_unit_limit(MAX_TX_UNITS))
+    for ix in instructions:
+        tx.add(ix)
+    msg = tx.compile_message()
+    return len(bytes(msg)) + 1 + 64 * msg.header.num_required_signatures
+
+def pack_instructions(instructions, fee_payer, units=DEFAULT_IX_UNITS):
+    # Greedily fill each transaction up to the packet size and the compute limit, keeping instruction order
+    max_items = max(1, MAX_TX_UNITS // units)
+    batches = []
+    batch = []
+    for ix in instructions:
+        if len(batch) > 0 and (len(batch) >= max_items or transaction_size(batch + [ix], fee_payer) > PACKET_DATA_SIZE):
+            batches.append(batch)
+            batch = []
+        batch.append(ix)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def split_instruction_logs(logs):
+    # Log messages grouped by top level instruction
+    groups = []
+    for log in logs:
+        if log.startswith('Program ') and log.endswith(' invoke [1]'):
+            groups.append([])
+        if len(groups) > 0:
+            groups[-1].append(log)
+    return groups
+
 def get_program(program_id, provider, idl_file):
     with open(idl_file) as f:
         idl = Idl.from_json(f.read())
     return Program(idl, translate_address(program_id), provider)
 
+class EventDecoder(object):
+    # Drop-in for EventParser.parse_logs with one struct per event compiled from the IDL
+    def __init__(self, program_id, coder):
+        self.program_id = str(program_id)
+        self.invoke = 'Program {} invoke ['.format(self.program_id)
+        self.events = {}
+        discriminators = {name: disc for disc, name in coder.events.discriminators.items()}
+        for event in coder.events.idl.events or []:
+            layout = coder.events.layouts[event.name]
+            names = [sc.name for sc in layout.subcon.subcon.subcons]
+            fmt = [EVENT_FIELDS.get(field.ty) for field in event.fields]
+            if None in fmt:
+                # Variable size events are left to the generic layout
+                decoder = (event.name, layout, None, None, None)
+            else:
+                ints = [i for i in range(len(fmt)) if fmt[i] == '16s']
+                keys = [i for i in range(len(fmt)) if fmt[i] == '32s']
+                decoder = (event.name, layout.datacls, names, struct.Struct('<' + ''.join(fmt)), (ints, keys))
+            self.events[discriminators[event.name]] = decoder
+
+    def decode(self, data):
+        decoder = self.events.get(data[:8])
+        if decoder is None:
+            return None
+        name, datacls, names, item, convert = decoder
+        if item is None:
+            return Event(name=name, data=datacls.parse(data[8:]))
+        values = list(item.unpack_from(data, 8))
+        for i in convert[0]:
+            values[i] = int.from_bytes(values[i], byteorder='little')
+        for i in convert[1]:
+            values[i] = Pubkey(values[i])
+        return Event(name=name, data=datacls(**dict(zip(names, values))))
+
+    def parse_logs(self, logs, callback):
+        # Only data logged while this program is the innermost invocation is decoded
+        stack = []
+        for log in logs:
+            if log.startswith(PROGRAM_DATA):
+                if len(stack) > 0 and stack[-1]:
+                    try:
+                        data = base64.b64decode(log.split(': ', 1)[1])
+                    except ValueError:
+                        continue
+                    event = self.decode(data)
+                    if event is not None:
+                        callback(event)
+            elif log.startswith('Program ') and (log.endswith(' success') or ' failed' in log):
+                if len(stack) > 0:
+                    stack.pop()
+            elif log.startswith('Program ') and ' invoke [' in log:
+                stack.append(log.startswith(self.invoke))
+
+@functools.lru_cache(maxsize=65536)
+def encode_order_key(order_key):
+    # Crockford base32 of the big-endian key, same output as krock32 without checksum
+    return base64.b32encode(order_key.to_bytes(16, byteorder='big'))[:26].translate(CROCKFORD_ENCODE).decode()
+
 def encode_order_id(buf):
-    rbuf = buf[::-1]
-    encoder = krock32.Encoder(checksum=False)
-    encoder.update(rbuf)
-    return encoder.finalize().lower()
+    return encode_order_key(int.from_bytes(buf, byteorder='little'))
 
 def decode_order_id(order_id):
-    decoder = krock32.Decoder(checksum=False)
-    decoder.update(order_id)
-    buf = decoder.finalize()
-    rbuf = buf[::-1]
+    buf = base64.b32decode(order_id.lower().translate(CROCKFORD_DECODE) + '======')
     return int.from_bytes(buf, byteorder='big')
 
-def decode_node(tag, blob):
+def decode_node(tag, buf, offset=0):
     data = None
     if tag == 1:
-        node_fmt = '<I16s3I24s'
-        rec = struct.unpack(node_fmt, blob)
+        rec = INNER_NODE.unpack_from(buf, offset)
         data = {
             'tag': rec[0],
             'key': rec[1],
@@ -66,185 +203,453 @@ def decode_node(tag, blob):
             'children': [rec[3], rec[4]],
         }
     if tag == 2:
-        node_fmt = '<2I16s32s'
-        rec = struct.unpack(node_fmt, blob)
+        rec = LEAF_NODE.unpack_from(buf, offset)
+        order_key = int.from_bytes(rec[2], byteorder='little')
         data = {
             'tag': rec[0],
             'slot': rec[1],
-            'key': rec[2],
+            'key': encode_order_key(order_key),
+            'order_key': order_key,
+            'price': order_key >> 64,
             'owner': Pubkey(rec[3]),
         }
-        price_fmt = '<8sQ'
-        price_rec = struct.unpack(price_fmt, data['key'])
-        data['price'] = price_rec[1]
-        data['key'] = encode_order_id(data['key'])
     if tag == 3 or tag == 4:
-        node_fmt = '<2I48s'
-        rec = struct.unpack(node_fmt, blob)
+        rec = FREE_NODE.unpack_from(buf, offset)
         data = {
             'tag': rec[0],
             'next': rec[1],
         }
     return data
 
-def decode_orders_map(map_data, pages):
-    header_size = map_data['header_size']
-    offset_size = map_data['offset_size']
+def slab_layout(type_data):
+    shape = (type_data['header_size'], type_data['offset_size'])
+    layout = SLAB_LAYOUTS.get(shape)
+    if layout is None:
+        space = PAGE_SIZE - (shape[0] + shape[1])
+        layout = {
+            'header_offset': shape[1],
+            'map_offset': shape[1] + MAP_HEADER.size,
+            'vec_offset': shape[1] + VEC_HEADER.size,
+            'map_per_page': space // 56,
+            'order_per_page': space // 32,
+            'settle_per_page': space // 24,
+        }
+        SLAB_LAYOUTS[shape] = layout
+    return layout
+
+def slab_page_count(alloc_items, inst_per_page):
+    return -(-alloc_items // inst_per_page)
+
+def decode_slab_pages(buf, offset):
+    # Type page headers followed by six 16 KB pages, all returned as views into buf
+    type_page = []
+    for i in range(4):
+        type_data = TYPE_PAGE.unpack_from(buf, offset + (i * TYPE_PAGE.size))
+        type_page.append({
+            'header_size': type_data[0],
+            'offset_size': type_data[1],
+            'alloc_items': type_data[2],
+            'alloc_pages': type_data[3:],
+        })
+    page_offset = offset + (4 * TYPE_PAGE.size)
+    pages = []
+    for i in range(6):
+        start_index = page_offset + (i * PAGE_SIZE)
+        end_index = start_index + PAGE_SIZE
+        pages.append(buf[start_index:end_index])
+    return type_page, pages
+
+def decode_slab_map(map_data, pages):
+    layout = slab_layout(map_data)
     alloc_items = map_data['alloc_items']
-    inst_per_page = math.floor((16384 - (header_size + offset_size)) / 56)
-    vector_fmt = "<{}s2Q2IQ{}s".format(offset_size, 16384 - (offset_size + 32))
-    node_fmt = "<I52s"
-    node_size = struct.calcsize(node_fmt)
-    total_pages = math.floor(alloc_items / inst_per_page)
-    if (alloc_items % inst_per_page) != 0:
-        total_pages = total_pages + 1
-    map_pages = []
-    for i in range(total_pages):
-        pidx = map_data['alloc_pages'][i]
-        map_pages.append(pages[pidx])
+    inst_per_page = layout['map_per_page']
     node_spec = {'nodes': []}
-    for i in range(len(map_pages)):
-        res = struct.unpack(vector_fmt, map_pages[i])
-        if i == 0:
-            node_spec['bump_index'] = res[1]
-            node_spec['free_list_len'] = res[2]
-            node_spec['free_list_head'] = res[3]
-            node_spec['root_node'] = res[4]
-            node_spec['leaf_count'] = res[5]
-        for node_idx in range(inst_per_page):
-            start_index = node_idx * node_size
-            end_index = start_index + node_size
-            node_blob = res[6][start_index:end_index]
-            node = struct.unpack(node_fmt, node_blob)
-            node_tag = node[0]
-            node_spec['nodes'].append(decode_node(node_tag, node_blob))
-            if len(node_spec['nodes']) == alloc_items:
-                i = len(map_pages)
-                break
+    header = slab_map_header(map_data, pages)
+    if header is not None:
+        node_spec.update(header)
+    for i in range(slab_page_count(alloc_items, inst_per_page)):
+        page = pages[map_data['alloc_pages'][i]]
+        count = min(inst_per_page, alloc_items - (i * inst_per_page))
+        for node_idx in range(count):
+            node_offset = layout['map_offset'] + (node_idx * 56)
+            node_tag = NODE_TAG.unpack_from(page, node_offset)[0]
+            node_spec['nodes'].append(decode_node(node_tag, page, node_offset))
     return node_spec
 
-def decode_orders_vec(vec_data, pages):
-    header_size = vec_data['header_size']
-    offset_size = vec_data['offset_size']
+def decode_slab_vec(vec_data, pages, inst_per_page, item):
+    layout = slab_layout(vec_data)
     alloc_items = vec_data['alloc_items']
-    inst_per_page = math.floor((16384 - (header_size + offset_size)) / 32)
-    vector_fmt = "<{}s2I{}s".format(offset_size, 16384 - (offset_size + 8))
-    order_fmt = "<Qq"
-    order_size = struct.calcsize(order_fmt)
-    total_pages = math.floor(alloc_items / inst_per_page)
-    if (alloc_items % inst_per_page) != 0:
-        total_pages = total_pages + 1
-    vec_pages = []
-    for i in range(total_pages):
-        pidx = vec_data['alloc_pages'][i]
-        vec_pages.append(pages[pidx])
-    order_spec = {'orders': []}
-    for i in range(len(vec_pages)):
-        res = struct.unpack(vector_fmt, vec_pages[i])
+    vec_spec = {'items': []}
+    for i in range(slab_page_count(alloc_items, inst_per_page)):
+        page = pages[vec_data['alloc_pages'][i]]
         if i == 0:
-            order_spec['free_top'] = res[1]
-            order_spec['next_index'] = res[2]
-        for order_idx in range(inst_per_page):
-            start_index = order_idx * order_size
-            end_index = start_index + order_size
-            order = struct.unpack(order_fmt, res[3][start_index:end_index])
-            order_spec['orders'].append({
-                'amount': order[0],
-                'expiry': order[1],
-            })
-            if len(order_spec['orders']) == alloc_items:
-                i = len(vec_pages)
-                break
+            res = VEC_HEADER.unpack_from(page, layout['header_offset'])
+            vec_spec['free_top'] = res[0]
+            vec_spec['next_index'] = res[1]
+        count = min(inst_per_page, alloc_items - (i * inst_per_page))
+        start_index = layout['vec_offset']
+        vec_spec['items'].extend(item.iter_unpack(page[start_index:start_index + (count * item.size)]))
+    return vec_spec
+
+def decode_orders_map(map_data, pages):
+    return decode_slab_map(map_data, pages)
+
+def decode_orders_vec(vec_data, pages):
+    vec_spec = decode_slab_vec(vec_data, pages, slab_layout(vec_data)['order_per_page'], ORDER_ITEM)
+    order_spec = {'orders': []}
+    for order in vec_spec.pop('items'):
+        order_spec['orders'].append({
+            'amount': order[0],
+            'expiry': order[1],
+        })
+    order_spec.update(vec_spec)
     return order_spec
 
-def decode_orderbook_side(side, map_data, vec_data):
+def slab_map_header(map_data, pages):
+    if map_data['alloc_items'] == 0:
+        return None
+    page = pages[map_data['alloc_pages'][0]]
+    res = MAP_HEADER.unpack_from(page, slab_layout(map_data)['header_offset'])
+    return {
+        'bump_index': res[0],
+        'free_list_len': res[1],
+        'free_list_head': res[2],
+        'root_node': res[3],
+        'leaf_count': res[4],
+    }
+
+def walk_slab_map(map_data, pages, descending=False, memo=None):
+    # In-order crit-bit traversal from the root, free list nodes are never reached
+    header = slab_map_header(map_data, pages)
+    if header is None or header['leaf_count'] == 0:
+        return
+    layout = slab_layout(map_data)
+    alloc_pages = map_data['alloc_pages']
+    inst_per_page = layout['map_per_page']
+    map_offset = layout['map_offset']
+    stack = [header['root_node']]
+    visited = 0
+    while len(stack) > 0:
+        visited = visited + 1
+        if visited > map_data['alloc_items']:
+            raise Exception('Invalid orderbook tree')
+        page_idx, node_idx = divmod(stack.pop(), inst_per_page)
+        pidx = alloc_pages[page_idx]
+        offset = map_offset + (node_idx * 56)
+        node = None
+        if memo is not None:
+            node = memo['nodes'][pidx].get(offset)
+        if node is None:
+            page = pages[pidx]
+            tag = NODE_TAG.unpack_from(page, offset)[0]
+            if tag == 1:
+                node = {
+                    'tag': tag,
+                    'children': INNER_CHILDREN.unpack_from(page, offset + 24),
+                }
+            elif tag == 2:
+                node = decode_node(tag, page, offset)
+            else:
+                raise Exception('Invalid orderbook tree')
+            if memo is not None:
+                memo['nodes'][pidx][offset] = node
+        if node['tag'] == 1:
+            children = node['children']
+            if descending:
+                stack.append(children[0])
+                stack.append(children[1])
+            else:
+                stack.append(children[1])
+                stack.append(children[0])
+        else:
+            yield node
+
+def decode_order(vec_data, pages, slot, memo=None):
+    layout = slab_layout(vec_data)
+    page_idx, order_idx = divmod(slot, layout['order_per_page'])
+    pidx = vec_data['alloc_pages'][page_idx]
+    offset = layout['vec_offset'] + (order_idx * ORDER_ITEM.size)
+    if memo is not None and offset in memo['orders'][pidx]:
+        return memo['orders'][pidx][offset]
+    order = ORDER_ITEM.unpack_from(pages[pidx], offset)
+    data = {
+        'amount': order[0],
+        'expiry': order[1],
+    }
+    if memo is not None:
+        memo['orders'][pidx][offset] = data
+    return data
+
+def update_page_memo(memo, orders_data, pages):
+    # Keep decoded nodes and orders for pages whose hash is unchanged since the previous decode
+    if memo.get('data') == orders_data:
+        return memo
+    hashes = [hashlib.blake2b(page, digest_size=16).digest() for page in pages]
+    if 'hashes' not in memo:
+        memo['nodes'] = [{} for page in pages]
+        memo['orders'] = [{} for page in pages]
+    else:
+        for i in range(len(pages)):
+            if memo['hashes'][i] != hashes[i]:
+                memo['nodes'][i] = {}
+                memo['orders'][i] = {}
+    memo['hashes'] = hashes
+    memo['data'] = orders_data
+    return memo
+
+def decode_orderbook_side(side, map_data, vec_data, pages, depth=None, memo=None, owners=None):
+    # Bids are returned best (highest key) first, asks lowest key first, owners collects each owner's orders
     book = []
-    for i in range(len(map_data['nodes'])):
-        node = map_data['nodes'][i]
-        if node and node['tag'] == 2:
-            order = vec_data['orders'][node['slot']]
-            order_item = {
-                'type': side,
-                'key': node['key'],
-                'price': node['price'],
-                'owner': node['owner'],
-                'amount': order['amount'],
-                'expiry': order['expiry'],
-            }
-            book.append(order_item)
+    nodes = walk_slab_map(map_data, pages, descending=(side == 'bid'), memo=memo)
+    if depth is not None:
+        nodes = itertools.islice(nodes, depth)
+    for node in nodes:
+        order = decode_order(vec_data, pages, node['slot'], memo)
+        order_item = {
+            'type': side,
+            'key': node['key'],
+            'order_key': node['order_key'],
+            'price': node['price'],
+            'owner': node['owner'],
+            'amount': order['amount'],
+            'expiry': order['expiry'],
+        }
+        book.append(order_item)
+        if owners is not None:
+            owners.setdefault(node['owner'], []).append(order_item)
     return book
 
+def decode_orderbook_compact(side, map_data, vec_data, pages, owner_table, depth=None, memo=None):
+    book = OrderBookSide(side, owner_table)
+    nodes = walk_slab_map(map_data, pages, descending=(side == 'bid'), memo=memo)
+    if depth is not None:
+        nodes = itertools.islice(nodes, depth)
+    for node in nodes:
+        order = decode_order(vec_data, pages, node['slot'], memo)
+        book.append(node['order_key'], node['owner'], order['amount'], order['expiry'], node['slot'])
+    return book
+
+def decode_orderbook_levels(side, map_data, vec_data, pages, levels=None, memo=None):
+    # Leaves arrive in price order, so each level is a run of equal prices
+    result = {'price': [], 'quantity': [], 'orders': []}
+    for node in walk_slab_map(map_data, pages, descending=(side == 'bid'), memo=memo):
+        order = decode_order(vec_data, pages, node['slot'], memo)
+        if len(result['price']) > 0 and result['price'][-1] == node['price']:
+            result['quantity'][-1] = result['quantity'][-1] + order['amount']
+            result['orders'][-1] = result['orders'][-1] + 1
+            continue
+        if levels is not None and len(result['price']) == levels:
+            break
+        result['price'].append(node['price'])
+        result['quantity'].append(order['amount'])
+        result['orders'].append(1)
+    return result
+
+def diff_orderbook_side(prev_side, side):
+    prev_index = {}
+    for order in prev_side:
+        prev_index[order['order_key']] = order
+    index = {}
+    for order in side:
+        index[order['order_key']] = order
+    added_keys = index.keys() - prev_index.keys()
+    removed_keys = prev_index.keys() - index.keys()
+    changed = []
+    for key in index.keys() & prev_index.keys():
+        if index[key]['amount'] != prev_index[key]['amount']:
+            changed.append({
+                'order': index[key],
+                'prev_amount': prev_index[key]['amount'],
+            })
+    return {
+        'added': [order for order in side if order['order_key'] in added_keys],
+        'removed': [order for order in prev_side if order['order_key'] in removed_keys],
+        'changed': changed,
+    }
+
+def diff_orderbook(prev_book, book):
+    if prev_book is None:
+        prev_book = {'bids': [], 'asks': []}
+    return {
+        'bids': diff_orderbook_side(prev_book['bids'], book['bids']),
+        'asks': diff_orderbook_side(prev_book['asks'], book['asks']),
+    }
+
+def slab_array(type_data, pages, dtype, data_offset, inst_per_page):
+    alloc_items = type_data['alloc_items']
+    parts = []
+    for i in range(slab_page_count(alloc_items, inst_per_page)):
+        pidx = type_data['alloc_pages'][i]
+        parts.append(np.frombuffer(pages[pidx], dtype=dtype, count=inst_per_page, offset=data_offset))
+    if len(parts) == 0:
+        return np.zeros(0, dtype=dtype)
+    if len(parts) == 1:
+        return parts[0][:alloc_items]
+    return np.concatenate(parts)[:alloc_items]
+
+def decode_orderbook_columns(side, map_data, vec_data, pages):
+    map_layout = slab_layout(map_data)
+    vec_layout = slab_layout(vec_data)
+    nodes = slab_array(map_data, pages, LEAF_DTYPE, map_layout['map_offset'], map_layout['map_per_page'])
+    orders = slab_array(vec_data, pages, ORDER_DTYPE, vec_layout['vec_offset'], vec_layout['order_per_page'])
+    leaves = nodes[nodes['tag'] == 2]
+    # Same ordering as the tree walk: bids highest key first, asks lowest key first
+    rank = np.lexsort((leaves['key_lo'], leaves['key_hi']))
+    if side == 'bid':
+        rank = rank[::-1]
+    leaves = leaves[rank]
+    slots = leaves['slot']
+    return {
+        'key_lo': leaves['key_lo'],
+        'price': leaves['key_hi'],
+        'owner': leaves['owner'],
+        'slot': slots,
+        'amount': orders['amount'][slots],
+        'expiry': orders['expiry'][slots],
+    }
+
+def decode_settlement_columns(map_data, vec_data, pages):
+    map_layout = slab_layout(map_data)
+    vec_layout = slab_layout(vec_data)
+    nodes = slab_array(map_data, pages, LEAF_DTYPE, map_layout['map_offset'], map_layout['map_per_page'])
+    entries = slab_array(vec_data, pages, SETTLE_DTYPE, vec_layout['vec_offset'], vec_layout['settle_per_page'])
+    leaves = nodes[nodes['tag'] == 2]
+    slots = leaves['slot']
+    return {
+        'owner': leaves['owner'],
+        'slot': slots,
+        'mkt_token_balance': entries['mkt_token_balance'][slots],
+        'prc_token_balance': entries['prc_token_balance'][slots],
+        'ts_updated': entries['ts_updated'][slots],
+    }
+
+def sum_settlement_balances(columns_list):
+    # Outstanding balances per owner across one or more columnar settlement logs
+    owner = np.concatenate([columns['owner'] for columns in columns_list])
+    owners, owner_idx = np.unique(owner, return_inverse=True)
+    result = {
+        'owner': owners,
+        'entries': np.bincount(owner_idx, minlength=len(owners)),
+    }
+    for field in ['mkt_token_balance', 'prc_token_balance']:
+        total = np.zeros(len(owners), dtype=np.uint64)
+        np.add.at(total, owner_idx, np.concatenate([columns[field] for columns in columns_list]))
+        result[field] = total
+    return result
+
 def decode_settlement_map(map_data, pages):
-    header_size = map_data['header_size']
-    offset_size = map_data['offset_size']
-    alloc_items = map_data['alloc_items']
-    inst_per_page = math.floor((16384 - (header_size + offset_size)) / 56)
-    vector_fmt = "<{}s2Q2IQ{}s".format(offset_size, 16384 - (offset_size + 32))
-    node_fmt = "<I52s"
-    node_size = struct.calcsize(node_fmt)
-    total_pages = math.floor(alloc_items / inst_per_page)
-    if (alloc_items % inst_per_page) != 0:
-        total_pages = total_pages + 1
-    map_pages = []
-    for i in range(total_pages):
-        pidx = map_data['alloc_pages'][i]
-        map_pages.append(pages[pidx])
-    node_spec = {'nodes': []}
-    for i in range(len(map_pages)):
-        res = struct.unpack(vector_fmt, map_pages[i])
-        if i == 0:
-            node_spec['bump_index'] = res[1]
-            node_spec['free_list_len'] = res[2]
-            node_spec['free_list_head'] = res[3]
-            node_spec['root_node'] = res[4]
-            node_spec['leaf_count'] = res[5]
-        for node_idx in range(inst_per_page):
-            start_index = node_idx * node_size
-            end_index = start_index + node_size
-            node_blob = res[6][start_index:end_index]
-            node = struct.unpack(node_fmt, node_blob)
-            node_tag = node[0]
-            node_spec['nodes'].append(decode_node(node_tag, node_blob))
-            if len(node_spec['nodes']) == alloc_items:
-                i = len(map_pages)
-                break
-    return node_spec
+    return decode_slab_map(map_data, pages)
 
 def decode_settlement_vec(vec_data, pages):
-    header_size = vec_data['header_size']
-    offset_size = vec_data['offset_size']
-    alloc_items = vec_data['alloc_items']
-    inst_per_page = math.floor((16384 - (header_size + offset_size)) / 24)
-    vector_fmt = "<{}s2I{}s".format(offset_size, 16384 - (offset_size + 8))
-    entry_fmt = "<QQq"
-    entry_size = struct.calcsize(entry_fmt)
-    total_pages = math.floor(alloc_items / inst_per_page)
-    if (alloc_items % inst_per_page) != 0:
-        total_pages = total_pages + 1
-    vec_pages = []
-    for i in range(total_pages):
-        pidx = vec_data['alloc_pages'][i]
-        vec_pages.append(pages[pidx])
+    vec_spec = decode_slab_vec(vec_data, pages, slab_layout(vec_data)['settle_per_page'], SETTLE_ITEM)
     entry_spec = {'entries': []}
-    for i in range(len(vec_pages)):
-        res = struct.unpack(vector_fmt, vec_pages[i])
-        if i == 0:
-            entry_spec['free_top'] = res[1]
-            entry_spec['next_index'] = res[2]
-        for entry_idx in range(inst_per_page):
-            start_index = entry_idx * entry_size
-            end_index = start_index + entry_size
-            entry = struct.unpack(entry_fmt, res[3][start_index:end_index])
-            entry_spec['entries'].append({
-                'mkt_token_balance': entry[0],
-                'prc_token_balance': entry[1],
-                'ts_updated': entry[2],
-            })
-            if len(entry_spec['entries']) == alloc_items:
-                i = len(vec_pages)
-                break
+    for entry in vec_spec.pop('items'):
+        entry_spec['entries'].append({
+            'mkt_token_balance': entry[0],
+            'prc_token_balance': entry[1],
+            'ts_updated': entry[2],
+        })
+    entry_spec.update(vec_spec)
     return entry_spec
 
+def market_scale(market_data):
+    scale = {}
+    for token in ['mkt', 'prc']:
+        decimals = market_data['{}_decimals'.format(token)]
+        scale[token] = {
+            'factor': 10 ** decimals,
+            'decimal': Decimal(10) ** Decimal(decimals),
+        }
+    return scale
+
+class OwnerTable(object):
+    # Interned owner keys shared by compact orderbook snapshots
+    def __init__(self):
+        self.owners = []
+        self.index = {}
+
+    def intern(self, owner):
+        idx = self.index.get(owner)
+        if idx is None:
+            idx = len(self.owners)
+            self.owners.append(owner)
+            self.index[owner] = idx
+        return idx
+
+class Order(object):
+    __slots__ = ('book', 'index')
+
+    def __init__(self, book, index):
+        self.book = book
+        self.index = index
+
+    @property
+    def type(self):
+        return self.book.side
+
+    @property
+    def price(self):
+        return self.book.prices[self.index]
+
+    @property
+    def amount(self):
+        return self.book.amounts[self.index]
+
+    @property
+    def expiry(self):
+        return self.book.expiries[self.index]
+
+    @property
+    def slot(self):
+        return self.book.slots[self.index]
+
+    @property
+    def owner(self):
+        return self.book.owner_table.owners[self.book.owner_idx[self.index]]
+
+    @property
+    def order_key(self):
+        return (self.book.prices[self.index] << 64) | self.book.key_lo[self.index]
+
+    @property
+    def key(self):
+        return encode_order_key(self.order_key)
+
+    def __repr__(self):
+        return 'Order({}, key={}, price={}, amount={})'.format(self.type, self.key, self.price, self.amount)
+
+class OrderBookSide(object):
+    # One side of the book stored as parallel arrays, indexing returns an Order view
+    def __init__(self, side, owner_table):
+        self.side = side
+        self.owner_table = owner_table
+        self.prices = array('Q')
+        self.key_lo = array('Q')
+        self.amounts = array('Q')
+        self.expiries = array('q')
+        self.slots = array('I')
+        self.owner_idx = array('I')
+
+    def append(self, order_key, owner, amount, expiry, slot):
+        self.prices.append(order_key >> 64)
+        self.key_lo.append(order_key & 0xFFFFFFFFFFFFFFFF)
+        self.amounts.append(amount)
+        self.expiries.append(expiry)
+        self.slots.append(slot)
+        self.owner_idx.append(self.owner_table.intern(owner))
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Order(self, i) for i in range(len(self.prices))[index]]
+        return Order(self, range(len(self.prices))[index])
+
+    def __iter__(self):
+        for i in range(len(self.prices)):
+            yield Order(self, i)
+
 class AquadexOrder(object):
     def __init__(self,
         side = 'bid', # or 'ask'
@@ -258,6 +663,7 @@ class AquadexOrder(object):
         expires = 0,
         preview = False,
         rollover = False,
+        raw = False, # quantity and prices are already integer token amounts
     ):
         if not(side == 'bid' or side == 'ask'):
             raise Exception('Invalid side')
@@ -272,6 +678,7 @@ class AquadexOrder(object):
         self.fill = fill
         self.preview = preview
         self.rollover = rollover
+        self.raw = raw
         if limit:
             self.price = price
             self.post = post
@@ -288,37 +695,156 @@ class AquadexMarket(object):
     def __init__(self, client, market_account_id):
         self.client = client
         self.market_id = market_account_id
+        self.book = None
+        self.vault = None
+        self.vault_id = None
+
+    def scale(self, token):
+        scale = self.client.market_scale.get(self.market_id)
+        if scale is None:
+            scale = market_scale(self.client.market[self.market_id])
+            self.client.market_scale[self.market_id] = scale
+        return scale[token]
 
     def format_decimals(self, amount, token):
-        market_data = self.client.market[self.market_id]
-        exponent = Decimal(10) ** Decimal(market_data['{}_decimals'.format(token)])
-        value = Decimal(amount) * exponent
+        value = Decimal(amount) * self.scale(token)['decimal']
         return int(value.quantize(Decimal('1')))
 
     def get_decimal(self, amount, token):
+        return Decimal(amount) / self.scale(token)['decimal']
+
+    def order_amount(self, order_rec, amount, token):
+        if order_rec.raw:
+            return int(amount)
+        return self.format_decimals(amount, token)
+
+    def to_raw(self, values, token):
+        # Convert a list or NumPy array of token amounts to integer amounts using one scale lookup
+        scale = self.scale(token)
+        if np is not None and isinstance(values, np.ndarray):
+            if values.dtype.kind in 'iu' and scale['factor'] <= 0xFFFFFFFFFFFFFFFF:
+                # Whole token amounts scale exactly in one vectorized multiply once the bounds are checked
+                limit = 0xFFFFFFFFFFFFFFFF // scale['factor']
+                if (values < 0).any() or (values > limit).any():
+                    raise Exception('Token amount out of range')
+                return values.astype(np.uint64) * np.uint64(scale['factor'])
+            # Exact Decimal math per element for floats, float64 loses precision above 2**53 raw units
+            return np.array(self.to_raw(values.tolist(), token), dtype=np.uint64)
+        result = []
+        for value in values:
+            value = Decimal(value)
+            if not(value.is_finite()):
+                raise Exception('Invalid token amount: {}'.format(value))
+            value = int((value * scale['decimal']).quantize(Decimal('1')))
+            if value < 0 or value > 0xFFFFFFFFFFFFFFFF:
+                raise Exception('Token amount out of range: {}'.format(value))
+            result.append(value)
+        return result
+
+    def from_raw(self, values, token, as_float=False):
+        scale = self.scale(token)
+        if np is not None and isinstance(values, np.ndarray):
+            if as_float:
+                return values / scale['factor']
+            values = values.tolist()
+        if as_float:
+            return [value / scale['factor'] for value in values]
+        return [Decimal(value) / scale['decimal'] for value in values]
+
+    async def fetch_orders(self):
         market_data = self.client.market[self.market_id]
-        exponent = Decimal(10) ** Decimal(market_data['{}_decimals'.format(token)])
-        value = Decimal(amount) / exponent
-        return value
+        resp = await self.client.async_client.get_account_info(Pubkey.from_string(market_data['orders']))
+        return resp.value.data
 
-    async def orderbook(self, data=None):
+    def convert_book(self, book):
+        mkt_scale = self.scale('mkt')['decimal']
+        prc_scale = self.scale('prc')['decimal']
+        for order in itertools.chain(book['asks'], book['bids']):
+            order['amount'] = Decimal(order['amount']) / mkt_scale
+            order['price'] = Decimal(order['price']) / prc_scale
+        return book
+
+    async def orderbook(self, data=None, columns=False, compact=False, raw=False):
         if data is None:
-            market_data = self.client.market[self.market_id]
-            resp = await self.client.async_client.get_account_info(Pubkey.from_string(market_data['orders']))
-            data = resp.value.data
-        book = self.client.decode_orderbook(data)
-        for order in book['asks']:
-            order['amount'] = self.get_decimal(order['amount'], 'mkt')
-            order['price'] = self.get_decimal(order['price'], 'prc')
-        for order in book['bids']:
-            order['amount'] = self.get_decimal(order['amount'], 'mkt')
-            order['price'] = self.get_decimal(order['price'], 'prc')
+            data = await self.fetch_orders()
+        # Columnar and compact books keep raw token amounts and prices
+        if columns:
+            return self.client.decode_orderbook(data, columns=True)
+        memo = self.client.orderbook_memo.setdefault(self.market_id, {})
+        if compact:
+            return self.client.decode_orderbook(data, compact=True, memo=memo)
+        book = self.client.decode_orderbook(data, memo=memo)
+        if raw:
+            return book
+        return self.convert_book(book)
+
+    async def depth(self, levels=None, side=None, data=None, raw=False):
+        if data is None:
+            data = await self.fetch_orders()
+        # Hashing every page for the memo costs more than a walk limited to a few levels
+        memo = None
+        if levels is None:
+            memo = self.client.orderbook_memo.setdefault(self.market_id, {})
+        book = self.client.decode_depth(data, levels=levels, memo=memo)
+        if not(raw):
+            for levels_data in book.values():
+                levels_data['price'] = self.from_raw(levels_data['price'], 'prc')
+                levels_data['quantity'] = self.from_raw(levels_data['quantity'], 'mkt')
+        if side == 'bid':
+            return book['bids']
+        elif side == 'ask':
+            return book['asks']
+        elif side is not None:
+            raise Exception('Invalid orderbook side')
         return book
 
+    async def stream_orderbook(self, ws_url=None, raw=False):
+        orders_id = self.client.market[self.market_id]['orders']
+        stream = self.client.orderbook_stream(ws_url)
+        queue = await stream.subscribe(orders_id)
+        try:
+            while True:
+                data = await queue.get()
+                if isinstance(data, Exception):
+                    raise data
+                yield await self.orderbook(data, raw=raw)
+        finally:
+            await stream.unsubscribe(orders_id, queue)
+
+    async def orderbook_diff(self, prev_snapshot, data=None):
+        book = await self.orderbook(data)
+        diff = diff_orderbook(prev_snapshot, book)
+        diff['book'] = book
+        return diff
+
+    async def top_of_book(self, depth=1, data=None, raw=False):
+        if data is None:
+            data = await self.fetch_orders()
+        # A depth limited walk only touches O(depth + tree height) nodes, so it skips the page memo
+        book = self.client.decode_orderbook(data, depth=depth)
+        if raw:
+            return book
+        return self.convert_book(book)
+
+    async def best_bid_ask(self, data=None, raw=False):
+        book = await self.top_of_book(1, data, raw)
+        return {
+            'bid': book['bids'][0] if len(book['bids']) > 0 else None,
+            'ask': book['asks'][0] if len(book['asks']) > 0 else None,
+        }
+
     def market_accounts(self, mode='trade'):
+        # Resolved once per (market, wallet, mode), trade accounts are rebuilt when the settlement logs rotate
         market_data = self.client.market[self.market_id]
         market_state = self.client.market_state[market_data['state']]
         user_pk = self.client.provider.wallet.public_key
+        version = None
+        if mode == 'trade':
+            version = (market_state['settle_a'], market_state['settle_b'])
+        cache_key = (self.market_id, user_pk, mode)
+        cached = self.client.market_accounts.get(cache_key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
         mkt_mint_pk = Pubkey.from_string(market_data['mkt_mint'])
         prc_mint_pk = Pubkey.from_string(market_data['prc_mint'])
         user_mkt_token_id = associated_token(mkt_mint_pk, user_pk)
@@ -342,23 +868,20 @@ class AquadexMarket(object):
                 'settle_a': Pubkey.from_string(market_state['settle_a']),
                 'settle_b': Pubkey.from_string(market_state['settle_b']),
             })
-        elif mode == 'cancel':
+        elif mode == 'cancel' or mode == 'withdraw':
             result.update({
                 'owner': user_pk,
                 'result': user_pk,
             })
+        self.client.market_accounts[cache_key] = (version, result)
         return result
 
-    async def order(self, *order, **order_spec):
-        if len(order) > 0:
-            order_rec = order[0]
-        else:
-            order_rec = AquadexOrder(**order_spec)
+    def order_instruction(self, order_rec):
         ot = order_rec.order_type
         if ot == 'limit_bid':
             ix = limit_bid({
-                'inp_quantity': self.format_decimals(order_rec.quantity, 'mkt'),
-                'inp_price_request': self.format_decimals(order_rec.price, 'prc'),
+                'inp_quantity': self.order_amount(order_rec, order_rec.quantity, 'mkt'),
+                'inp_price_request': self.order_amount(order_rec, order_rec.price, 'prc'),
                 'inp_post': order_rec.post,
                 'inp_fill': order_rec.fill,
                 'inp_expires': order_rec.expires,
@@ -367,8 +890,8 @@ class AquadexMarket(object):
             }, self.market_accounts(), program_id=self.client.program_id)
         elif ot == 'limit_ask':
             ix = limit_ask({
-                'inp_quantity': self.format_decimals(order_rec.quantity, 'mkt'),
-                'inp_price_request': self.format_decimals(order_rec.price, 'prc'),
+                'inp_quantity': self.order_amount(order_rec, order_rec.quantity, 'mkt'),
+                'inp_price_request': self.order_amount(order_rec, order_rec.price, 'prc'),
                 'inp_post': order_rec.post,
                 'inp_fill': order_rec.fill,
                 'inp_expires': order_rec.expires,
@@ -377,113 +900,286 @@ class AquadexMarket(object):
             }, self.market_accounts(), program_id=self.client.program_id)
         elif ot == 'market_bid':
             ix = market_bid({
-                'inp_by_quantity': self.by_quantity,
-                'inp_quantity': self.format_decimals(order_rec.quantity, 'mkt'),
-                'inp_net_price': self.format_decimals(order_rec.net_price, 'prc'),
+                'inp_by_quantity': order_rec.by_quantity,
+                'inp_quantity': self.order_amount(order_rec, order_rec.quantity, 'mkt'),
+                'inp_net_price': self.order_amount(order_rec, order_rec.net_price, 'prc'),
                 'inp_fill': order_rec.fill,
                 'inp_preview': order_rec.preview,
                 'inp_rollover': order_rec.rollover,
             }, self.market_accounts(), program_id=self.client.program_id)
         elif ot == 'market_ask':
             ix = market_ask({
-                'inp_by_quantity': self.by_quantity,
-                'inp_quantity': self.format_decimals(order_rec.quantity, 'mkt'),
-                'inp_net_price': self.format_decimals(order_rec.net_price, 'prc'),
+                'inp_by_quantity': order_rec.by_quantity,
+                'inp_quantity': self.order_amount(order_rec, order_rec.quantity, 'mkt'),
+                'inp_net_price': self.order_amount(order_rec, order_rec.net_price, 'prc'),
                 'inp_fill': order_rec.fill,
                 'inp_preview': order_rec.preview,
                 'inp_rollover': order_rec.rollover,
             }, self.market_accounts(), program_id=self.client.program_id)
-        recent_blockhash = (await self.client.provider.connection.get_latest_blockhash('confirmed')).value.blockhash
-        tx = Transaction(recent_blockhash=recent_blockhash)
-        tx.add(ix)
-        self.client.provider.wallet.sign_transaction(tx)
+        else:
+            raise Exception('Invalid order type: {}'.format(ot))
+        return ix
+
+    def trade_result(self, log):
+        return_data = base64.b64decode(json.loads(log.to_json())['result']['meta']['returnData']['data'][0])
+        return_data = TradeResult.discriminator + return_data
+        return_data = return_data + bytearray(56 - len(return_data))
+        return_data = TradeResult.decode(return_data).to_json()
+        return_data['order_id'] = encode_order_key(return_data['order_id'])
+        return return_data
+
+    def order_event_result(self, evt):
+        # Same fields as trade_result, for orders whose return data was overwritten by a later instruction
+        return {
+            'tokens_received': evt.tokens_received,
+            'tokens_sent': evt.tokens_sent,
+            'tokens_fee': evt.tokens_fee,
+            'posted_quantity': evt.posted_quantity,
+            'order_id': encode_order_key(evt.order_id),
+        }
+
+    async def order(self, *order, **order_spec):
+        if len(order) > 0:
+            order_rec = order[0]
+        else:
+            order_rec = AquadexOrder(**order_spec)
+        ix = self.order_instruction(order_rec)
+        latest_blockhash = await self.client.latest_blockhash()
+        tx = self.client.build_transaction([ix], latest_blockhash)
         sig = await self.client.provider.send(tx)
-        for i in range(10):
-            log = await self.client.fetch_transaction(sig)
-            if not(log):
-                await asyncio.sleep(0.5)
-                continue
-            return_data = base64.b64decode(json.loads(log.to_json())['result']['meta']['returnData']['data'][0])
-            return_data = TradeResult.discriminator + return_data
-            return_data = return_data + bytearray(56 - len(return_data))
-            return_data = TradeResult.decode(return_data).to_json()
-            return_data['order_id'] = encode_order_id(return_data['order_id'].to_bytes(16, 'little'))
-            return return_data
-        raise Exception('Transaction log not found for: {}'.format(sig))
+        log = await self.client.confirm_transaction(sig, latest_blockhash.last_valid_block_height)
+        return self.trade_result(log)
 
-    async def cancel_order(self, side, order_id):
+    async def submit_orders(self, orders, max_in_flight=8):
+        # Yields (index, result) in completion order, a failed order yields its exception as the result
+        latest_blockhash = await self.client.latest_blockhash()
+        txs = []
+        for order_rec in orders:
+            if isinstance(order_rec, dict):
+                order_rec = AquadexOrder(**order_rec)
+            txs.append(self.client.build_transaction([self.order_instruction(order_rec)], latest_blockhash))
+        window = asyncio.Semaphore(max_in_flight)
+
+        async def submit(index, tx):
+            async with window:
+                try:
+                    sig = await self.client.provider.send(tx)
+                    log = await self.client.confirm_transaction(sig, latest_blockhash.last_valid_block_height)
+                    return index, self.trade_result(log)
+                except Exception as error:
+                    return index, error
+
+        tasks = [asyncio.ensure_future(submit(index, tx)) for index, tx in enumerate(txs)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def cancel_instruction(self, side, order_id):
         if side == 'bid':
             side_code = 0
         elif side == 'ask':
             side_code = 1
         else:
             raise Exception('Invalid orderbook side')
-        ix = cancel_order({
+        return cancel_order({
             'inp_side': side_code,
             'inp_order_id': decode_order_id(order_id),
         }, self.market_accounts('cancel'), program_id=self.client.program_id)
-        recent_blockhash = (await self.client.provider.connection.get_latest_blockhash('confirmed')).value.blockhash
-        tx = Transaction(recent_blockhash=recent_blockhash)
-        tx.add(ix)
-        self.client.provider.wallet.sign_transaction(tx)
+
+    async def cancel_order(self, side, order_id):
+        ix = self.cancel_instruction(side, order_id)
+        latest_blockhash = await self.client.latest_blockhash()
+        tx = self.client.build_transaction([ix], latest_blockhash)
         sig = await self.client.provider.send(tx)
-        program = get_program(self.client.program_id, self.client.provider, self.client.idl_file)
-        parser = EventParser(program.program_id, program.coder)
-        for i in range(10):
-            log = await self.client.fetch_transaction(sig)
-            if not(log):
-                await asyncio.sleep(0.5)
-                continue
-            meta = json.loads(log.to_json())['result']['meta']
-            evts = []
-            parser.parse_logs(meta['logMessages'], lambda evt: evts.append(evt))
-            return evts[0].data
+        parser = self.client.event_parser()
+        log = await self.client.confirm_transaction(sig, latest_blockhash.last_valid_block_height)
+        meta = json.loads(log.to_json())['result']['meta']
+        evts = []
+        parser.parse_logs(meta['logMessages'], lambda evt: evts.append(evt))
+        return evts[0].data
+
+    async def send_packed(self, ixs, items, units=DEFAULT_IX_UNITS):
+        # First event of each instruction in item order, items of a failed transaction get an exception naming them
+        batches = pack_instructions(ixs, self.client.provider.wallet.public_key, units)
+        outcomes = await self.client.send_instructions(batches, units)
+        txres = []
+        for batch, outcome in zip(batches, outcomes):
+            batch_items = items[len(txres):len(txres) + len(batch)]
+            if not(isinstance(outcome, Exception)):
+                events = self.client.instruction_events(outcome)
+                if len(events) == len(batch) and all(len(evts) > 0 for evts in events):
+                    txres.extend([evts[0].data for evts in events])
+                    continue
+                outcome = Exception('Events missing from transaction log')
+            error = Exception('Transaction failed for {}: {}'.format(batch_items, outcome))
+            txres.extend([error] * len(batch))
+        return txres
+
+    async def cancel_orders(self, orders, units=DEFAULT_IX_UNITS):
+        # Cancel events for (side, order_id) pairs in input order, packed into as few transactions as fit
+        orders = list(orders)
+        ixs = [self.cancel_instruction(side, order_id) for side, order_id in orders]
+        return await self.send_packed(ixs, orders, units)
 
-    async def get_settlement_logs(self, user_wallet=None):
+    async def requote(self, cancels, new_orders):
+        # Cancels then new orders in a single transaction, so either the whole quote update lands or none of it
+        orders = [AquadexOrder(**order_rec) if isinstance(order_rec, dict) else order_rec for order_rec in new_orders]
+        ixs = [self.cancel_instruction(side, order_id) for side, order_id in cancels]
+        ixs = ixs + [self.order_instruction(order_rec) for order_rec in orders]
+        result = {
+            'cancels': [],
+            'orders': [],
+        }
+        if len(ixs) == 0:
+            return result
+        if transaction_size(ixs, self.client.provider.wallet.public_key) > PACKET_DATA_SIZE:
+            raise Exception('Requote does not fit in one transaction')
+        log = (await self.client.send_instructions([ixs]))[0]
+        if isinstance(log, Exception):
+            raise Exception('Requote failed for cancels {} and {} new orders: {}'.format(cancels, len(orders), log))
+        events = self.client.instruction_events(log)
+        if len(events) != len(ixs):
+            raise Exception('Requote events missing from transaction log')
+        for cancel, evts in zip(cancels, events[:len(cancels)]):
+            found = [evt.data for evt in evts if evt.name == 'CancelEvent']
+            if len(found) == 0:
+                raise Exception('CancelEvent missing for: {}'.format(cancel))
+            result['cancels'].append(found[0])
+        for index, evts in enumerate(events[len(cancels):]):
+            found = [evt.data for evt in evts if evt.name == 'OrderEvent']
+            if len(found) == 0:
+                raise Exception('OrderEvent missing for new order: {}'.format(index))
+            result['orders'].append(self.order_event_result(found[0]))
+        # Return data is only kept for the last instruction
+        if len(orders) > 0:
+            result['orders'][-1] = self.trade_result(log)
+        return result
+
+    async def replace_order(self, side, old_order_id, new_order):
+        result = await self.requote([(side, old_order_id)], [new_order])
+        return {
+            'cancel': result['cancels'][0],
+            'order': result['orders'][0],
+        }
+
+    async def open_orders(self, owner=None, data=None, raw=False):
+        # Resting orders of owner (the wallet by default), bids then asks, from the owner index of the decoded book
+        if owner is None:
+            owner = self.client.provider.wallet.public_key
+        elif isinstance(owner, str):
+            owner = Pubkey.from_string(owner)
+        book = await self.orderbook(data, raw=raw)
+        return book['owners'].get(owner, [])
+
+    async def cancel_all(self, owner=None, data=None, units=DEFAULT_IX_UNITS):
+        # Cancel instructions are signed by the wallet, so only the wallet's own orders can be cancelled
+        user_pk = self.client.provider.wallet.public_key
+        if isinstance(owner, str):
+            owner = Pubkey.from_string(owner)
+        if owner is not None and owner != user_pk:
+            raise Exception('Only orders owned by the wallet can be cancelled: {}'.format(owner))
+        orders = await self.open_orders(user_pk, data, raw=True)
+        return await self.cancel_orders([(order['type'], order['key']) for order in orders], units)
+
+    async def fetch_settlement_chain(self):
+        # Prefetch every known link in one batch, then only fetch links discovered past the known chain
+        market_data = self.client.market[self.market_id]
+        known = [market_data['settle0']] + self.client.settlement_chain.get(self.market_id, [])
+        market_state = self.client.market_state.get(market_data['state'])
+        if market_state is not None:
+            known = known + [market_state['settle_a'], market_state['settle_b']]
+        accounts = await self.client.fetch_account_data(list(dict.fromkeys(known)))
+        chain = []
+        log_item = market_data['settle0']
+        while True:
+            if log_item not in accounts:
+                accounts.update(await self.client.fetch_account_data([log_item]))
+            log_account = accounts[log_item]
+            if log_account is None:
+                raise Exception('Settlement log not found: {}'.format(log_item))
+            chain.append((log_item, log_account))
+            log_item = str(Pubkey(bytes(log_account[64:96])))
+            if log_item == '11111111111111111111111111111111':
+                break
+            if len(chain) > len(accounts):
+                raise Exception('Invalid settlement log chain')
+        self.client.settlement_chain[self.market_id] = [item[0] for item in chain]
+        return chain
+
+    async def settlement_balances(self):
+        logs = []
+        for log_item, log_account in await self.fetch_settlement_chain():
+            logs.append(self.client.decode_settlement_log(log_account, columns=True)['entries'])
+        return sum_settlement_balances(logs)
+
+    async def get_settlement_logs(self, user_wallet=None, user_wallets=None):
+        # With user_wallets each log is decoded once and 'entries' maps every wallet to its entries
         log_data = {}
         log_seq = []
-        log_entries = []
-        log_item = self.client.market[self.market_id]['settle0']
-        while True:
-            log_resp = await self.client.async_client.get_account_info(Pubkey.from_string(log_item))
-            sl = self.client.decode_settlement_log(log_resp.value.data, user_wallet)
+        if user_wallets is None:
+            log_entries = []
+        else:
+            user_wallets = [Pubkey.from_string(w) if isinstance(w, str) else w for w in user_wallets]
+            log_entries = {w: [] for w in user_wallets}
+        for log_item, log_account in await self.fetch_settlement_chain():
+            if user_wallets is None:
+                sl = self.client.decode_settlement_log(log_account, user_wallet)
+            else:
+                sl = self.client.decode_settlement_index(log_account)
             log_data[log_item] = sl
-            for e in sl['entries']:
-                prev_log = sl['header']['prev']
-                next_log = sl['header']['next']
-                if str(prev_log) == '11111111111111111111111111111111':
-                    prev_log = Pubkey.from_string(log_item)
-                if str(next_log) == '11111111111111111111111111111111':
-                    next_log = Pubkey.from_string(log_item)
-                log_entries.append({
-                    'log': Pubkey.from_string(log_item),
-                    'prev': prev_log,
-                    'next': next_log,
-                })
+            prev_log = sl['header']['prev']
+            next_log = sl['header']['next']
+            if str(prev_log) == '11111111111111111111111111111111':
+                prev_log = Pubkey.from_string(log_item)
+            if str(next_log) == '11111111111111111111111111111111':
+                next_log = Pubkey.from_string(log_item)
+            log_link = {
+                'log': Pubkey.from_string(log_item),
+                'prev': prev_log,
+                'next': next_log,
+            }
+            if user_wallets is None:
+                for e in sl['entries']:
+                    log_entries.append(dict(log_link))
+            else:
+                for w in user_wallets:
+                    for e in sl['owners'].get(w, []):
+                        log_entries[w].append(dict(log_link))
             log_seq.append(log_item)
-            log_item = str(sl['header']['next'])
-            if log_item == '11111111111111111111111111111111':
-                break
         return {
             'entries': log_entries,
             'data': log_data,
             'logs': log_seq,
         }
 
+    async def withdraw_vault(self):
+        # Vault account id when the wallet's vault holds tokens, else False, the vault prefetched by load_market is used once
+        if self.vault_id is not None:
+            vault_account_id = self.vault_id
+            vault_data = self.vault
+            self.vault = None
+            self.vault_id = None
+        else:
+            user_pk = self.client.provider.wallet.public_key
+            vault_account_id = program_address([bytes(Pubkey.from_string(self.market_id)), bytes(user_pk)], self.client.program_id)
+            vault_resp = await self.client.fetch_user_vault(vault_account_id)
+            vault_data = vault_resp.to_json() if vault_resp is not None else None
+        if vault_data is not None and (vault_data['mkt_tokens'] > 0 or vault_data['prc_tokens'] > 0):
+            return vault_account_id
+        return False
+
     async def has_withdraw(self):
         # Loop through settlement logs
         entries = []
         vault = False
         found = False
         # Check user vault
-        user_pk = self.client.provider.wallet.public_key
-        vault_account_id = program_address([bytes(Pubkey.from_string(self.market_id)), bytes(user_pk)], self.client.program_id)
-        vault_resp = await self.client.fetch_user_vault(vault_account_id)
-        if vault_resp is not None:
-            vault_data = vault_resp.to_json()
-            if vault_data['mkt_tokens'] > 0 or vault_data['prc_tokens'] > 0:
-                vault = vault_account_id
-                found = True
+        vault = await self.withdraw_vault()
+        if vault:
+            found = True
         # Check settlement logs
         logs = await self.get_settlement_logs(user_wallet=self.client.provider.wallet.public_key)
         if len(logs['entries']) > 0:
@@ -496,117 +1192,371 @@ class AquadexMarket(object):
             'vault': vault,
         }
 
-    async def withdraw(self, param={}):
+    async def withdraw(self, param={}, units=DEFAULT_IX_UNITS):
         log_entries = param.get('entries', None)
         vault = param.get('vault', None)
         if log_entries is None:
             logs = await self.get_settlement_logs(user_wallet=self.client.provider.wallet.public_key)
             log_entries = logs['entries']
         if vault is None:
-            user_pk = self.client.provider.wallet.public_key
-            vault_account_id = program_address([bytes(Pubkey.from_string(self.market_id)), bytes(user_pk)], self.client.program_id)
-            vault_resp = await self.client.fetch_user_vault(vault_account_id)
-            if vault_resp is not None:
-                vault_data = vault_resp.to_json()
-                if vault_data['mkt_tokens'] > 0 or vault_data['prc_tokens'] > 0:
-                    vault = vault_account_id
-        market_data = self.client.market[self.market_id]
-        market_state = self.client.market_state[market_data['state']]
+            vault = await self.withdraw_vault()
         user_pk = self.client.provider.wallet.public_key
-        mkt_mint_pk = Pubkey.from_string(market_data['mkt_mint'])
-        prc_mint_pk = Pubkey.from_string(market_data['prc_mint'])
-        user_mkt_token_id = associated_token(mkt_mint_pk, user_pk)
-        user_prc_token_id = associated_token(prc_mint_pk, user_pk)
-        txres = []
+        accounts = self.market_accounts('withdraw')
+        ixs = []
         for entry in log_entries:
-            ix = log_withdraw({
-                'market': Pubkey.from_string(self.market_id),
-                'state': Pubkey.from_string(market_data['state']),
-                'agent': Pubkey.from_string(market_data['agent']),
-                'user_mkt_token': Pubkey.from_string(user_mkt_token_id),
-                'user_prc_token': Pubkey.from_string(user_prc_token_id),
-                'mkt_vault': Pubkey.from_string(market_data['mkt_vault']),
-                'prc_vault': Pubkey.from_string(market_data['prc_vault']),
-                'owner': user_pk,
+            ixs.append(log_withdraw(dict(accounts, **{
                 'settle': entry['log'],
                 'settle_prev': entry['prev'],
                 'settle_next': entry['next'],
-                'result': user_pk,
-                'spl_token_prog': SPL_TOKEN,
-            }, program_id=self.client.program_id)
-            recent_blockhash = (await self.client.provider.connection.get_latest_blockhash('confirmed')).value.blockhash
-            tx = Transaction(recent_blockhash=recent_blockhash)
-            tx.add(ix)
-            self.client.provider.wallet.sign_transaction(tx)
-            sig = await self.client.provider.send(tx)
-            program = get_program(self.client.program_id, self.client.provider, self.client.idl_file)
-            parser = EventParser(program.program_id, program.coder)
-            for i in range(10):
-                log = await self.client.fetch_transaction(sig)
-                if not(log):
-                    await asyncio.sleep(0.5)
-                    continue
-                meta = json.loads(log.to_json())['result']['meta']
-                evts = []
-                parser.parse_logs(meta['logMessages'], lambda evt: evts.append(evt))
-                txres.append(evts[0].data)
-                break
+            }), program_id=self.client.program_id))
         if vault:
-            ix = vault_withdraw({
-                'market': Pubkey.from_string(self.market_id),
-                'state': Pubkey.from_string(market_data['state']),
-                'agent': Pubkey.from_string(market_data['agent']),
-                'owner': user_pk,
-                'result': user_pk,
+            ixs.append(vault_withdraw(dict(accounts, **{
                 'vault': Pubkey.from_string(vault),
-                'user_mkt_token': Pubkey.from_string(user_mkt_token_id),
-                'user_prc_token': Pubkey.from_string(user_prc_token_id),
-                'mkt_vault': Pubkey.from_string(market_data['mkt_vault']),
-                'prc_vault': Pubkey.from_string(market_data['prc_vault']),
-                'spl_token_prog': SPL_TOKEN,
-            }, program_id=self.client.program_id)
-            recent_blockhash = (await self.client.provider.connection.get_latest_blockhash('confirmed')).value.blockhash
-            tx = Transaction(recent_blockhash=recent_blockhash)
-            tx.add(ix)
-            self.client.provider.wallet.sign_transaction(tx)
-            sig = await self.client.provider.send(tx) 
-            program = get_program(self.client.program_id, self.client.provider, self.client.idl_file)
-            parser = EventParser(program.program_id, program.coder)
-            for i in range(10):
-                log = await self.client.fetch_transaction(sig)
-                if not(log):
-                    await asyncio.sleep(0.5)
-                    continue
-                meta = json.loads(log.to_json())['result']['meta']
-                evts = []
-                parser.parse_logs(meta['logMessages'], lambda evt: evts.append(evt))
-                txres.append(evts[0].data)
-                break
-        return txres
+            }), program_id=self.client.program_id))
+        # Pack the withdrawals into as few transactions as fit, results stay in instruction order
+        items = [str(entry['log']) for entry in log_entries]
+        if vault:
+            items.append('vault {}'.format(vault))
+        return await self.send_packed(ixs, items, units)
+
+class BookTracker(object):
+    def __init__(self, market):
+        self.market = market
+        self.book = None
+
+    async def update(self, data=None):
+        diff = await self.market.orderbook_diff(self.book, data)
+        self.book = diff['book']
+        return diff
+
+class BlockhashCache(object):
+    # Keeps a recent blockhash refreshed in the background while transactions are being built
+    def __init__(self, connection, interval=10.0, max_age=30.0, idle=60.0, commitment='confirmed'):
+        self.connection = connection
+        self.interval = interval
+        self.max_age = max_age
+        self.idle = idle
+        self.commitment = commitment
+        self.value = None
+        self.fetched = None
+        self.used = None
+        self.refreshing = None
+        self.task = None
+
+    def get(self):
+        # Cached blockhash and last_valid_block_height, None when missing or too close to expiry
+        loop = asyncio.get_running_loop()
+        self.used = loop.time()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        if self.value is None or loop.time() - self.fetched > self.max_age:
+            return None
+        return self.value
+
+    async def latest(self):
+        value = self.get()
+        if value is None:
+            value = await self.refresh()
+        return value
+
+    async def refresh(self):
+        # Concurrent callers share one getLatestBlockhash request
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.ensure_future(self.fetch())
+        return await asyncio.shield(self.refreshing)
+
+    async def fetch(self):
+        fetched = asyncio.get_running_loop().time()
+        resp = await self.connection.get_latest_blockhash(self.commitment)
+        self.value = resp.value
+        self.fetched = fetched
+        return self.value
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while loop.time() - self.used < self.idle:
+            if self.value is None or loop.time() - self.fetched >= self.interval:
+                try:
+                    await self.refresh()
+                except Exception:
+                    # Transient RPC failures are retried on the next interval
+                    pass
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+class SignatureConfirmer(object):
+    # Polls getSignatureStatuses for every in-flight signature with one request per interval
+    def __init__(self, connection, interval=0.25, commitment='confirmed', max_failures=20):
+        self.connection = connection
+        self.interval = interval
+        self.commitment = commitment
+        self.max_failures = max_failures
+        self.pending = {}
+        self.task = None
+
+    async def confirm(self, sig, last_valid_block_height=None, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[sig] = (future, last_valid_block_height)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise Exception('Transaction not confirmed before timeout for: {}'.format(sig))
+        finally:
+            self.pending.pop(sig, None)
+
+    def resolve(self, sig, status=None, error=None):
+        future = self.pending.pop(sig)[0]
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(status)
+
+    async def poll(self):
+        sigs = list(self.pending)
+        resps = await asyncio.gather(*[
+            self.connection.get_signature_statuses(sigs[i:i + 256]) for i in range(0, len(sigs), 256)
+        ])
+        statuses = itertools.chain(*[resp.value for resp in resps])
+        for sig, status in zip(sigs, statuses):
+            if status is None or sig not in self.pending:
+                continue
+            if status.err is not None:
+                self.resolve(sig, error=Exception('Transaction failed for: {}: {}'.format(sig, status.err)))
+            # A missing confirmation status means the transaction is already rooted
+            elif status.confirmation_status in CONFIRMED_STATUS or status.confirmation_status is None:
+                self.resolve(sig, status)
+        # Only signatures whose status was just checked can be expired, later registrations wait for the next poll
+        expiring = [sig for sig in sigs if sig in self.pending and self.pending[sig][1] is not None]
+        if len(expiring) > 0:
+            block_height = (await self.connection.get_block_height(self.commitment)).value
+            for sig in expiring:
+                if sig in self.pending and block_height > self.pending[sig][1]:
+                    self.resolve(sig, error=Exception('Blockhash expired before confirmation for: {}'.format(sig)))
+
+    async def run(self):
+        failures = 0
+        while len(self.pending) > 0:
+            try:
+                await self.poll()
+                failures = 0
+            except Exception as error:
+                # Transient RPC failures are retried on the next interval, persistent ones fail every waiter
+                failures = failures + 1
+                if failures >= self.max_failures:
+                    for sig in list(self.pending):
+                        self.resolve(sig, error=Exception('Signature status polling failed for: {}: {}'.format(sig, error)))
+                    failures = 0
+            await asyncio.sleep(self.interval)
+
+class OrderbookStream(object):
+    # One websocket carrying accountSubscribe for any number of orders accounts, resubscribing after reconnects
+    def __init__(self, ws_url, commitment='confirmed', reconnect_delay=1.0):
+        self.ws_url = ws_url
+        self.commitment = commitment
+        self.reconnect_delay = reconnect_delay
+        self.queues = {}
+        self.subscriptions = {}
+        self.pending = {}
+        self.request_id = 0
+        self.ws = None
+        self.task = None
+
+    async def subscribe(self, account_id):
+        queue = asyncio.Queue(maxsize=1)
+        if account_id not in self.queues:
+            self.queues[account_id] = []
+            if self.ws is not None:
+                try:
+                    await self.send_subscribe(account_id)
+                except websockets.WebSocketException:
+                    # A closing socket is reconnected by run, which resubscribes every account
+                    pass
+        self.queues[account_id].append(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    async def unsubscribe(self, account_id, queue):
+        queues = self.queues.get(account_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if len(queues) > 0:
+            return
+        self.queues.pop(account_id, None)
+        for sub_id, sub_account in list(self.subscriptions.items()):
+            if sub_account == account_id:
+                del self.subscriptions[sub_id]
+                if self.ws is not None:
+                    try:
+                        await self.send('accountUnsubscribe', [sub_id])
+                    except websockets.WebSocketException:
+                        pass
+        if len(self.queues) == 0 and self.ws is not None:
+            await self.ws.close()
+
+    async def send(self, method, params):
+        self.request_id = self.request_id + 1
+        await self.ws.send(json.dumps({'jsonrpc': '2.0', 'id': self.request_id, 'method': method, 'params': params}))
+        return self.request_id
+
+    async def send_subscribe(self, account_id):
+        request_id = await self.send('accountSubscribe', [account_id, {'encoding': 'base64', 'commitment': self.commitment}])
+        self.pending[request_id] = account_id
+
+    def deliver(self, account_id, item):
+        # Account data or an exception for every consumer of account_id
+        for queue in self.queues.get(account_id, []):
+            # Only the latest account state is kept for slow consumers
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def handle(self, msg):
+        if not(isinstance(msg, dict)):
+            return
+        if msg.get('id') in self.pending:
+            account_id = self.pending.pop(msg['id'])
+            if 'error' in msg:
+                self.deliver(account_id, Exception('Orderbook subscription failed for {}: {}'.format(account_id, msg['error'])))
+            elif 'result' in msg and account_id in self.queues:
+                self.subscriptions[msg['result']] = account_id
+            return
+        if msg.get('method') != 'accountNotification':
+            return
+        try:
+            account_id = self.subscriptions.get(msg['params']['subscription'])
+            value = msg['params']['result']['value']
+            # A null value is a closed account, there is no orderbook to deliver
+            if account_id is None or value is None:
+                return
+            data = base64.b64decode(value['data'][0])
+        except (KeyError, IndexError, TypeError, ValueError):
+            # Malformed notifications are skipped
+            return
+        self.deliver(account_id, data)
+
+    async def run(self):
+        while len(self.queues) > 0:
+            try:
+                async with websockets.connect(self.ws_url, max_size=None) as ws:
+                    self.ws = ws
+                    self.subscriptions = {}
+                    self.pending = {}
+                    for account_id in list(self.queues):
+                        await self.send_subscribe(account_id)
+                    async for message in ws:
+                        try:
+                            msg = json.loads(message)
+                        except ValueError:
+                            continue
+                        self.handle(msg)
+            except (OSError, websockets.WebSocketException):
+                pass
+            except Exception as error:
+                # Anything else stops the stream, consumers receive the error instead of waiting forever
+                for account_id in list(self.queues):
+                    self.deliver(account_id, error)
+                raise
+            finally:
+                self.ws = None
+            if len(self.queues) > 0:
+                await asyncio.sleep(self.reconnect_delay)
 
 class AquadexClient(object):
-    def __init__(self, async_client, provider, program_id=None, idl_file='idl/aqua_dex.json'):
+    def __init__(self, async_client, provider, program_id=None, idl_file='idl/aqua_dex.json', ws_url=None):
         self.async_client = async_client
         self.provider = provider
         self.idl_file = idl_file
+        self.ws_url = ws_url
         self.market = {}
         self.market_state = {}
+        self.market_accounts = {}
+        self.orderbook_memo = {}
+        self.owner_table = OwnerTable()
+        self.market_scale = {}
+        self.settlement_chain = {}
+        self.streams = {}
+        self.confirmer = SignatureConfirmer(provider.connection if provider is not None else async_client)
+        self.blockhash = BlockhashCache(provider.connection if provider is not None else async_client)
+        # Wall-clock limit per confirmation, on top of the blockhash expiry
+        self.confirm_timeout = 90.0
+        self.program = None
+        self.parser = None
+        self.fast_events = True
+        self.signed = {}
         if program_id is None:
             self.program_id = DEFAULT_AQUADEX_PROGRAM_ID
         else:
             self.program_id = Pubkey.from_string(program_id)
 
-    async def load_market(self, market_account_id, state=True):
+    def set_market(self, market_account_id, info):
+        self.market[market_account_id] = info.to_json()
+        self.market_scale[market_account_id] = market_scale(self.market[market_account_id])
+
+    async def load_market(self, market_account_id, state=True, with_orders=False, with_vault=False):
+        if not(with_orders or with_vault):
+            if market_account_id not in self.market:
+                info = await self.fetch_market(market_account_id)
+                if info is None:
+                    raise Exception('Market not found: {}'.format(market_account_id))
+                self.set_market(market_account_id, info)
+            if state:
+                await self.load_market_state(self.market[market_account_id]['state'])
+            return AquadexMarket(self, market_account_id)
+        # Fetch everything that can be derived in one batch, then the accounts named by the market
+        vault_account_id = None
+        if with_vault:
+            user_pk = self.provider.wallet.public_key
+            vault_account_id = program_address([bytes(Pubkey.from_string(market_account_id)), bytes(user_pk)], self.program_id)
+        accounts = {}
         if market_account_id not in self.market:
-            info = await self.fetch_market(market_account_id)
-            self.market[market_account_id] = info.to_json()
-        if state:
-            await self.load_market_state(self.market[market_account_id]['state'])
-        return AquadexMarket(self, market_account_id)
+            batch = [market_account_id]
+            if with_vault:
+                batch.append(vault_account_id)
+            accounts = await self.fetch_accounts(batch)
+            info = self.decode_account(Market, accounts[market_account_id])
+            if info is None:
+                raise Exception('Market not found: {}'.format(market_account_id))
+            self.set_market(market_account_id, info)
+        market_data = self.market[market_account_id]
+        batch = []
+        if state and market_data['state'] not in self.market_state:
+            batch.append(market_data['state'])
+        if with_orders:
+            batch.append(market_data['orders'])
+        if with_vault and vault_account_id not in accounts:
+            batch.append(vault_account_id)
+        if len(batch) > 0:
+            accounts.update(await self.fetch_accounts(batch))
+        if market_data['state'] in accounts:
+            info = self.decode_account(MarketState, accounts[market_data['state']])
+            if info is None:
+                raise Exception('Market state not found: {}'.format(market_data['state']))
+            self.market_state[market_data['state']] = info.to_json()
+        market = AquadexMarket(self, market_account_id)
+        if with_orders:
+            if accounts[market_data['orders']] is None:
+                raise Exception('Orders account not found: {}'.format(market_data['orders']))
+            market.book = await market.orderbook(accounts[market_data['orders']].data)
+        if with_vault:
+            vault = self.decode_account(UserVault, accounts[vault_account_id])
+            market.vault = vault.to_json() if vault is not None else None
+            market.vault_id = vault_account_id
+        return market
 
     async def load_market_state(self, state_account_id, refresh=False):
         if refresh or state_account_id not in self.market_state:
             info = await self.fetch_market_state(state_account_id)
+            if info is None:
+                raise Exception('Market state not found: {}'.format(state_account_id))
             self.market_state[state_account_id] = info.to_json()
             return info
         return self.market_state[state_account_id]
@@ -620,43 +1570,141 @@ class AquadexClient(object):
     async def fetch_user_vault(self, vault_account_id):
         return await UserVault.fetch(self.async_client, Pubkey.from_string(vault_account_id), program_id=self.program_id)
 
+    def orderbook_stream(self, ws_url=None):
+        if ws_url is None:
+            ws_url = self.ws_url
+        if ws_url is None:
+            raise Exception('Websocket url not specified')
+        if ws_url not in self.streams:
+            self.streams[ws_url] = OrderbookStream(ws_url)
+        return self.streams[ws_url]
+
+    async def fetch_accounts(self, account_ids):
+        # Accounts by account id, None for missing accounts, one getMultipleAccounts call per 100 accounts
+        batches = [account_ids[i:i + 100] for i in range(0, len(account_ids), 100)]
+        resps = await asyncio.gather(*[
+            self.async_client.get_multiple_accounts([Pubkey.from_string(account_id) for account_id in batch]) for batch in batches
+        ])
+        result = {}
+        for batch, resp in zip(batches, resps):
+            for account_id, account in zip(batch, resp.value):
+                result[account_id] = account
+        return result
+
+    async def fetch_account_data(self, account_ids):
+        accounts = await self.fetch_accounts(account_ids)
+        return {account_id: account.data if account is not None else None for account_id, account in accounts.items()}
+
+    def decode_account(self, account_cls, account):
+        if account is None:
+            return None
+        if account.owner != self.program_id:
+            raise ValueError('Account does not belong to this program')
+        return account_cls.decode(account.data)
+
+    def build_transaction(self, instructions, latest_blockhash, units=DEFAULT_IX_UNITS):
+        # Identical messages under one blockhash would share a signature, repeats get a distinct compute unit limit
+        tx = Transaction(recent_blockhash=latest_blockhash.blockhash, fee_payer=self.provider.wallet.public_key)
+        for ix in instructions:
+            tx.add(ix)
+        signed = self.signed.setdefault(latest_blockhash.blockhash, {})
+        while len(self.signed) > 8:
+            del self.signed[next(iter(self.signed))]
+        message = tx.serialize_message()
+        repeat = signed.get(message, 0)
+        signed[message] = repeat + 1
+        # Estimates above the default allotment always need an explicit limit, transaction_size leaves room for it
+        if repeat > 0 or units > DEFAULT_IX_UNITS:
+            unit_limit = min(max(units, DEFAULT_IX_UNITS) * len(instructions), MAX_TX_UNITS) - repeat
+            tx = Transaction(recent_blockhash=latest_blockhash.blockhash, fee_payer=self.provider.wallet.public_key)
+            tx.add(set_compute_unit_limit(unit_limit))
+            for ix in instructions:
+                tx.add(ix)
+        self.provider.wallet.sign_transaction(tx)
+        return tx
+
+    async def send_instructions(self, batches, units=DEFAULT_IX_UNITS):
+        # One transaction per batch, all signed against the same blockhash, sent together and confirmed in bulk
+        if len(batches) == 0:
+            return []
+        latest_blockhash = await self.latest_blockhash()
+        txs = [self.build_transaction(batch, latest_blockhash, units) for batch in batches]
+
+        async def submit(tx):
+            sig = await self.provider.send(tx)
+            return await self.confirm_transaction(sig, latest_blockhash.last_valid_block_height)
+
+        # Per batch, the confirmed transaction or the exception that stopped it, one failure does not lose the others
+        return await asyncio.gather(*[submit(tx) for tx in txs], return_exceptions=True)
+
+    def instruction_events(self, log):
+        # Events emitted by each top level instruction of this program in a confirmed transaction
+        meta = json.loads(log.to_json())['result']['meta']
+        parser = self.event_parser()
+        invoke = 'Program {} invoke'.format(self.program_id)
+        result = []
+        for logs in split_instruction_logs(meta['logMessages']):
+            if not(logs[0].startswith(invoke)):
+                continue
+            evts = []
+            parser.parse_logs(logs, lambda evt: evts.append(evt))
+            result.append(evts)
+        return result
+
+    def load_program(self):
+        # The IDL is read once per client and the Program is shared by every market
+        if self.program is None:
+            self.program = get_program(self.program_id, self.provider, self.idl_file)
+        return self.program
+
+    def event_parser(self):
+        if self.parser is None:
+            program = self.load_program()
+            if self.fast_events:
+                self.parser = EventDecoder(program.program_id, program.coder)
+            else:
+                self.parser = EventParser(program.program_id, program.coder)
+        return self.parser
+
     async def fetch_transaction(self, txid):
         return await self.provider.connection.get_transaction(txid, commitment='confirmed')
 
-    def decode_settlement_log(self, settle_data, user_wallet=None):
-        outer_fmt = "<32s32s32sIH{}s".format(len(settle_data) - (32 + 32 + 32 + 4 + 2))
-        inner_fmt = "<3Q16H"
-        inner_size = struct.calcsize(inner_fmt)
-        page_fmt = "<{}s".format(16384 * 6)
-        # Unpack the outer struct
-        outer_unpacked = struct.unpack(outer_fmt, settle_data)
-        # Unpack the inner structs from the outer struct
-        type_page = []
-        for i in range(4):
-            start_index = i * inner_size
-            end_index = start_index + inner_size
-            type_data = struct.unpack(inner_fmt, outer_unpacked[5][start_index:end_index])
-            type_page.append({
-                'header_size': type_data[0],
-                'offset_size': type_data[1],
-                'alloc_items': type_data[2],
-                'alloc_pages': type_data[3:],
-            })
-        pages = []
-        page_data = outer_unpacked[5][end_index:]
-        for i in range(6):
-            start_index = i * 16384
-            end_index = start_index + 16384
-            pages.append(page_data[start_index:end_index])
+    async def latest_blockhash(self):
+        # Served from the background cache, only waits on RPC when the cache is cold or stale
+        return await self.blockhash.latest()
+
+    async def confirm_transaction(self, sig, last_valid_block_height=None, timeout=None):
+        # Wait for the shared status poller, stopping at blockhash expiry or the timeout, then fetch the transaction once
+        if timeout is None:
+            timeout = self.confirm_timeout
+        await self.confirmer.confirm(sig, last_valid_block_height, timeout)
+        log = await self.fetch_transaction(sig)
+        if not(log):
+            raise Exception('Transaction log not found for: {}'.format(sig))
+        return log
+
+    def decode_settlement_log(self, settle_data, user_wallet=None, columns=False):
+        buf = memoryview(settle_data)
+        header = SETTLE_HEADER.unpack_from(buf, 0)
+        type_page, pages = decode_slab_pages(buf, SETTLE_HEADER.size)
         result = {
             'header': {
-                'market': Pubkey(outer_unpacked[0]),
-                'prev': Pubkey(outer_unpacked[1]),
-                'next': Pubkey(outer_unpacked[2]),
+                'market': Pubkey(header[0]),
+                'prev': Pubkey(header[1]),
+                'next': Pubkey(header[2]),
             },
         }
         settle_map = type_page[0]
         settle_vec = type_page[1]
+        if columns:
+            if np is None:
+                raise Exception('NumPy is required for columnar settlement log decoding')
+            entries = decode_settlement_columns(settle_map, settle_vec, pages)
+            if user_wallet is not None:
+                mask = entries['owner'] == np.void(bytes(user_wallet))
+                entries = {field: values[mask] for field, values in entries.items()}
+            result['entries'] = entries
+            return result
         map_data = decode_settlement_map(settle_map, pages)
         vec_data = decode_settlement_vec(settle_vec, pages)
         entries = []
@@ -674,43 +1722,50 @@ class AquadexClient(object):
         result['entries'] = entries
         return result
 
-    def decode_orderbook(self, orders_data):
-        outer_fmt = "<H{}s".format(len(orders_data) - 2)
-        inner_fmt = "<3Q16H"
-        inner_size = struct.calcsize(inner_fmt)
-        page_fmt = "<{}s".format(16384 * 6)
-        # Unpack the outer struct
-        outer_unpacked = struct.unpack(outer_fmt, orders_data)
-        # Unpack the inner structs from the outer struct
-        type_page = []
-        for i in range(4):
-            start_index = i * inner_size
-            end_index = start_index + inner_size
-            type_data = struct.unpack(inner_fmt, outer_unpacked[1][start_index:end_index])
-            type_page.append({
-                'header_size': type_data[0],
-                'offset_size': type_data[1],
-                'alloc_items': type_data[2],
-                'alloc_pages': type_data[3:],
-            })
-        pages = []
-        page_data = outer_unpacked[1][end_index:]
-        for i in range(6):
-            start_index = i * 16384
-            end_index = start_index + 16384
-            pages.append(page_data[start_index:end_index])
+    def decode_settlement_index(self, settle_data):
+        # Decode every entry once and group them by owner
+        result = self.decode_settlement_log(settle_data)
+        owners = {}
+        for entry in result['entries']:
+            owners.setdefault(entry['owner'], []).append(entry)
+        result['owners'] = owners
+        return result
+
+    def decode_depth(self, orders_data, levels=None, memo=None):
+        type_page, pages = decode_slab_pages(memoryview(orders_data), 2)
+        if memo is not None:
+            update_page_memo(memo, orders_data, pages)
+        return {
+            'bids': decode_orderbook_levels('bid', type_page[0], type_page[2], pages, levels, memo),
+            'asks': decode_orderbook_levels('ask', type_page[1], type_page[3], pages, levels, memo),
+        }
+
+    def decode_orderbook(self, orders_data, columns=False, depth=None, memo=None, compact=False):
+        type_page, pages = decode_slab_pages(memoryview(orders_data), 2)
         bid_map = type_page[0]
         ask_map = type_page[1]
         bid_vec = type_page[2]
         ask_vec = type_page[3]
-        bid_map_data = decode_orders_map(bid_map, pages)
-        ask_map_data = decode_orders_map(ask_map, pages)
-        bid_vec_data = decode_orders_vec(bid_vec, pages)
-        ask_vec_data = decode_orders_vec(ask_vec, pages)
-        bids = decode_orderbook_side('bid', bid_map_data, bid_vec_data)
-        asks = decode_orderbook_side('ask', ask_map_data, ask_vec_data)
+        if columns:
+            if np is None:
+                raise Exception('NumPy is required for columnar orderbook decoding')
+            return {
+                'bids': decode_orderbook_columns('bid', bid_map, bid_vec, pages),
+                'asks': decode_orderbook_columns('ask', ask_map, ask_vec, pages),
+            }
+        if memo is not None:
+            update_page_memo(memo, orders_data, pages)
+        if compact:
+            return {
+                'bids': decode_orderbook_compact('bid', bid_map, bid_vec, pages, self.owner_table, depth, memo),
+                'asks': decode_orderbook_compact('ask', ask_map, ask_vec, pages, self.owner_table, depth, memo),
+            }
+        owners = {}
+        bids = decode_orderbook_side('bid', bid_map, bid_vec, pages, depth, memo, owners)
+        asks = decode_orderbook_side('ask', ask_map, ask_vec, pages, depth, memo, owners)
         return {
             'bids': bids,
             'asks': asks,
+            'owners': owners,
         }
 
@@ -29,12 +29,10 @@ async def main():
     #pprint.pprint(book)
 
     if True:
-        for order in book['asks']:
-            print('Ask ' + order['key'])
-            print(await market.cancel_order('ask', order['key']))
-        for order in book['bids']:
-            print('Bid ' + order['key'])
-            print(await market.cancel_order('ask', order['key']))
+        cancels = [('ask', order['key']) for order in book['asks']] + [('bid', order['key']) for order in book['bids']]
+        for (side, order_id), evt in zip(cancels, await market.cancel_orders(cancels)):
+            print(side.capitalize() + ' ' + order_id)
+            print(evt)
 
     # close socket
     await client.close()